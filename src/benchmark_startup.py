@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from startup_bundle import load_startup_bundle
+
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+# each snippet runs in a fresh interpreter so imports are measured cold, like a new worker
+PICKLE_STARTUP = """
+from model import Model
+from data_transformer import DataTransformer
+from matcher import Matcher
+from startup_bundle import MODEL_PATH
+
+model = Model()
+model.load_model(MODEL_PATH)
+Matcher(model=model, data_transformer=DataTransformer())
+"""
+
+BUNDLE_STARTUP = """
+from model import Model
+from data_transformer import DataTransformer
+from matcher import Matcher
+from startup_bundle import load_startup_bundle
+
+bundle = load_startup_bundle()
+model = Model()
+model.load_bundle(bundle)
+Matcher(model=model, data_transformer=DataTransformer(bundle=bundle))
+"""
+
+TIMED = """
+import json, sys, time
+start = time.perf_counter()
+exec(compile({snippet!r}, "<startup>", "exec"))
+print(json.dumps({{"seconds": time.perf_counter() - start, "modules": len(sys.modules)}}))
+"""
+
+
+def measure(snippet, repeats):
+    timings = []
+    modules = 0
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", TIMED.format(snippet=snippet)],
+            cwd=current_dir, capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result["seconds"])
+        modules = result["modules"]
+    return statistics.median(timings), min(timings), modules
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cold start time of a matcher worker.")
+    parser.add_argument("--repeats", type=int, default=5, help="number of fresh interpreters per variant")
+    args = parser.parse_args()
+
+    # a missing, stale or unreadable bundle would make the bundle variant crash in every subprocess
+    if load_startup_bundle() is None:
+        sys.exit("No usable startup bundle, build it first with: python src/startup_bundle.py")
+
+    for name, snippet in (("pickle + json", PICKLE_STARTUP), ("startup bundle", BUNDLE_STARTUP)):
+        median, best, modules = measure(snippet, args.repeats)
+        print(f"{name:>15}: median {median * 1000:.0f} ms, best {best * 1000:.0f} ms, {modules} modules imported")
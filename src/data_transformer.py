@@ -8,11 +8,9 @@ import numpy as np
 from colormath.color_diff import delta_e_cie2000
 from colormath.color_objects import sRGBColor, LabColor
 from colormath.color_conversions import convert_color
-from gensim.models import KeyedVectors
 from pyproj import CRS, Transformer
 from shapely.geometry import Point, MultiLineString, LineString
 from shapely.ops import unary_union, transform
-from sklearn.metrics.pairwise import cosine_similarity
 
 
 from constants import API_URL
@@ -25,8 +23,16 @@ def patch_asscalar(a):
 setattr(np, 'asscalar', patch_asscalar)
 
 class DataTransformer:
-    def __init__(self):
-        self.type_similarity_matrix = self._load_type_similarity_matrix()
+    def __init__(self, bundle=None):
+        self.type_ids = None
+        self.type_similarity_array = None
+        if bundle is not None:
+            self.type_ids = {type_name: type_id for type_id, type_name in enumerate(bundle["type_names"].tolist())}
+            self.type_similarity_array = bundle["type_similarity"]
+            self.type_similarity_matrix = None
+        else:
+            self.type_similarity_matrix = self._load_type_similarity_matrix()
+        self.transformer = None
 
     def prepare_data(self, lost_item : item_to_process, found_item: item_to_process):
         type_similarity = self._compute_type_similarity(lost_item.type, found_item.type)
@@ -54,7 +60,15 @@ class DataTransformer:
         }
 
     def _compute_type_similarity(self, lost_item_type, found_item_type):
-        if self.type_similarity_matrix.get(lost_item_type) is None:
+        if self.type_similarity_array is not None:
+            lost_type_id = self.type_ids.get(lost_item_type)
+            found_type_id = self.type_ids.get(found_item_type)
+            if lost_type_id is None or found_type_id is None:
+                return 0
+            return float(self.type_similarity_array[lost_type_id, found_type_id])
+
+        # a type missing from the matrix, lost or found, is not similar to anything
+        if self.type_similarity_matrix.get(lost_item_type) is None or self.type_similarity_matrix.get(found_item_type) is None:
             return 0
         similarity = self.type_similarity_matrix[lost_item_type].get(found_item_type, 0)
         if not similarity:
@@ -161,11 +175,12 @@ class DataTransformer:
         return geom
     
     def _transform_geometry_to_wgs84(self, geom):
-        source_crs = CRS.from_epsg(4326)
-        target_crs = CRS.from_epsg(32633)
-
-        transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
-        geom_wgs84 = transform(transformer.transform, geom)
+        # building the transformer is expensive, so it is created once and reused
+        if self.transformer is None:
+            source_crs = CRS.from_epsg(4326)
+            target_crs = CRS.from_epsg(32633)
+            self.transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
+        geom_wgs84 = transform(self.transformer.transform, geom)
 
         return geom_wgs84
         
@@ -260,6 +275,11 @@ class DataTransformer:
             return public_transport_lines_overlap_ratio
         return 0
 
+    def get_projected_bounds(self, item_location):
+        geom = self._get_geometry(item_location)
+        geom = self._transform_geometry_to_wgs84(geom)
+        return geom.bounds
+
     def get_types_from_db(self):
         response = requests.get(f"{API_URL}/config/types").json()
         if response["success"]:
@@ -272,6 +292,10 @@ class DataTransformer:
         if self.type_similarity_matrix:
             return self.type_similarity_matrix
 
+        # only needed offline, gensim and sklearn are slow to import
+        from gensim.models import KeyedVectors
+        from sklearn.metrics.pairwise import cosine_similarity
+
         all_types = self.get_types_from_db()
         print("All types: ", all_types)
 
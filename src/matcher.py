@@ -3,7 +3,6 @@ import requests
 from typing import Generator, List
 
 import numpy as np
-import pandas as pd
 
 from constants import API_URL
 from contracts import item_to_process, match_result
@@ -14,7 +13,8 @@ def patch_asscalar(a):
     return a.item()
 
 setattr(np, 'asscalar', patch_asscalar)
-    
+
+MATCH_PROBABILITY_THRESHOLD = 0.05
 
 class Matcher:
     def __init__(self, model, data_transformer):
@@ -34,11 +34,10 @@ class Matcher:
             found_item = item if item.item_type == "found" else item_to_process.from_dict(item_to_compare)
 
             prepared_data = self.data_transformer.prepare_data(lost_item, found_item)
-            prepared_df = pd.DataFrame(prepared_data, index=[0])
-            prepared_df = prepared_df.reindex(columns=self.model.feature_names, fill_value=0)
+            prepared_row = np.array([[prepared_data.get(name, 0) for name in self.model.feature_names]], dtype=np.float64)
 
-            probability = self.model.predict(prepared_df.values)
-            if probability > 0.05:
+            probability = self.model.predict(prepared_row)
+            if probability > MATCH_PROBABILITY_THRESHOLD:
                 yield match_result(lost_id=lost_item.id, found_id=found_item.id, match_probability=probability)
 
     ## SPREMANJE LOKACIJA SAD RADI, DALJE TREBA POBOLJŠATI MODEL
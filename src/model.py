@@ -1,17 +1,23 @@
+import argparse
+import hashlib
 import os
 import pickle
+import resource
+import time
 
-import pandas as pd
-from sklearn.calibration import CalibratedClassifierCV
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import train_test_split, GridSearchCV
-from sklearn.metrics import accuracy_score, f1_score
+import numpy as np
+
+from startup_bundle import ForestArrays, build_startup_bundle
 
 
 class Model:
     def load_model(self, model_path):
         self.model = pickle.load(open(model_path, 'rb'))
         self.feature_names = self.model.feature_names
+
+    def load_bundle(self, bundle):
+        self.model = ForestArrays(bundle)
+        self.feature_names = self.model.feature_names
     
     def predict(self, X):
         # X.reindex(columns=self.feature_names, fill_value=0)
@@ -19,37 +25,63 @@ class Model:
         print(f"Prediction: {prediction}")
         return prediction[0][1]
 
-    def train(self, grid_search=False):
+    def predict_batch(self, X):
+        return self.model.predict_proba(X)[:, 1]
+
+    def train(self, search=False, calibrate=False, n_candidates=60, max_resources=300):
+        # training dependencies are imported here so the service can load a model without them
+        from sklearn.calibration import CalibratedClassifierCV
+        from sklearn.ensemble import RandomForestClassifier
+        from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+        from sklearn.model_selection import train_test_split, HalvingRandomSearchCV
+        from sklearn.metrics import accuracy_score, f1_score
+        from joblib.externals.loky import get_reusable_executor
+
+        # with factor 3 and two halving rounds the search starts at max_resources / 9 trees
+        factor = 3
+        min_resources = max_resources // factor ** 2
+        if search and min_resources < 1:
+            raise ValueError(f"max_resources must be at least {factor ** 2}, got {max_resources}")
+
+        start_time = time.perf_counter()
         current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        df = pd.read_csv(current_dir + "/model/data.csv")
-
-        X = df.drop("label", axis=1)
-        y = df["label"]
+        X, y = self.load_dataset(current_dir + "/model/data.csv")
+        print(f"Loaded dataset in {time.perf_counter() - start_time:.2f}s")
 
         X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=41)
 
         params = None
-        if grid_search:
-            rf = RandomForestClassifier()
+        if search:
+            rf = RandomForestClassifier(random_state=41)
 
-            param_grid = {
-                'n_estimators': [100, 200, 300],  # The number of trees in the forest.
+            param_distributions = {
                 'criterion': ['gini', 'entropy'],  # The function to measure the quality of a split.
                 'max_depth': [None, 10, 20, 30],  # The maximum depth of the tree.
                 'min_samples_split': [2, 5, 10],  # The minimum number of samples required to split an internal node.
                 'min_samples_leaf': [1, 2, 4],  # The minimum number of samples required to be at a leaf node.
-                'max_features': ['auto', 'sqrt', 'log2', None],  # The number of features to consider when looking for the best split.
+                'max_features': ['sqrt', 'log2', None],  # The number of features to consider when looking for the best split.
                 'bootstrap': [True, False],  # Whether bootstrap samples are used when building trees.
                 'class_weight': ['balanced', 'balanced_subsample', None]  # Weights associated with classes. This could be useful if you have imbalance between classes.
             }
 
-            print("Choosing best hyperparameters...")
-            grid_search = GridSearchCV(estimator=rf, param_grid=param_grid, cv=5, verbose=2, n_jobs=-1)
-            grid_search.fit(X_train, y_train)
-
-            best_params = grid_search.best_params_
-            params = best_params
-            print("Best hyperparameters: ", best_params)
+            # n_estimators is the resource being halved: n_candidates random configurations start with few trees
+            # and only the best third of each round gets more, up to max_resources trees
+            print(f"Choosing best hyperparameters from {n_candidates} candidates...")
+            search_start_time = time.perf_counter()
+            halving_search = HalvingRandomSearchCV(
+                estimator=rf, param_distributions=param_distributions, n_candidates=n_candidates,
+                resource="n_estimators", min_resources=min_resources, max_resources=max_resources,
+                factor=factor, cv=5, random_state=41, verbose=1, n_jobs=-1,
+                # the final forest is fitted below from best_params_, a refit here would be thrown away
+                refit=False
+            )
+            halving_search.fit(X_train, y_train)
+
+            params = dict(halving_search.best_params_)
+            # when the candidates run out before the last round the best one was scored with fewer trees
+            params["n_estimators"] = max_resources
+            print("Best hyperparameters: ", params)
+            print(f"Hyperparameter search took {time.perf_counter() - search_start_time:.2f}s")
 
         if not params:
              params = {
@@ -63,44 +95,75 @@ class Model:
                 "n_estimators": 200
             }
 
-        model = RandomForestClassifier(**params )
+        model = RandomForestClassifier(**params, n_jobs=-1)
+
+        if calibrate:
+            # the calibrator fits its own copy of the forest per fold, so the forest is not fitted on its own
+            print("Training calibrated model using Random Forest Classifier...")
+            model = CalibratedClassifierCV(model, method="isotonic")
+            model.fit(X_train, y_train)
+        else:
+            print("Training model using Random Forest Classifier...")
+            model.fit(X_train, y_train)
 
-        print("Training model using Random Forest Classifier...")
+        forests = self._get_forests(model)
 
-        model.fit(X_train, y_train)
+        # --- Uncomment to see feature importances ---
+        feature_names = X_train.columns
+        feature_importances = np.mean([forest.feature_importances_ for forest in forests], axis=0)
 
-        calibrator = CalibratedClassifierCV(model, method="isotonic")
-        calibrator.fit(X_train, y_train)
+        print("Feature importances: ")
+        for feature_name, feature_importance in zip(feature_names, feature_importances):
+                print(f"Feature: {feature_name}, Importance: {feature_importance}")
 
         y_pred = model.predict(X_test)
-        y_prob = model.predict_proba(X_test)
 
         accuracy = accuracy_score(y_test, y_pred)
         f1 = f1_score(y_test, y_pred)
 
         print("Accuracy score: ", accuracy, "F1 score: ", f1)
-        
-        # --- Uncomment to see feature importances ---
-        feature_names = X_train.columns
-        feature_importances = model.feature_importances_
-
-        print("Feature importances: ")
-        for feature_name, feature_importance in zip(feature_names, feature_importances):
-                print(f"Feature: {feature_name}, Importance: {feature_importance}")
 
         self.test_model(model)
 
+        # all cores are only used for fitting, a pickled n_jobs=-1 would start a thread pool on every predict
+        for forest in forests:
+            forest.set_params(n_jobs=None)
+        if calibrate:
+            # the unfitted forest kept as the calibrator's template carries it too
+            model.set_params(**{key: None for key, value in model.get_params().items() if key.endswith("__n_jobs") and value == -1})
+
         self.model = model
         self.model.feature_names = X.columns
+        self.feature_names = self.model.feature_names
 
         pickle.dump(self.model, open(os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + "/model/model.pkl", "wb"))
+        build_startup_bundle()
+
+        # ru_maxrss is reported in kilobytes on Linux
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"Training took {time.perf_counter() - start_time:.2f}s, peak memory {peak_memory:.0f} MB")
+
+        if search:
+            # only the search runs in loky worker processes, the forests are fitted with threads in this process.
+            # the workers are kept alive by joblib and only show up in RUSAGE_CHILDREN once shut down and reaped
+            get_reusable_executor().shutdown(wait=True)
+            peak_worker_memory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+            print(f"Peak memory of the largest loky search worker {peak_worker_memory:.0f} MB")
+
+    def _get_forests(self, model):
+        if hasattr(model, "calibrated_classifiers_"):
+            # the fitted forest is called base_estimator before sklearn 1.2
+            return [
+                calibrated_classifier.estimator if getattr(calibrated_classifier, "estimator", None) is not None else calibrated_classifier.base_estimator
+                for calibrated_classifier in model.calibrated_classifiers_
+            ]
+        return [model]
 
     def test_model(self, model):
-        current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        test_df = pd.read_csv(current_dir + "/model/test_data.csv")
+        from sklearn.metrics import accuracy_score, f1_score
 
-        test_X = test_df.drop("label", axis=1)
-        test_y = test_df["label"]
+        current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        test_X, test_y = self.load_dataset(current_dir + "/model/test_data.csv")
 
         y_pred = model.predict(test_X)
 
@@ -110,6 +173,39 @@ class Model:
         print("Test dataset accuracy score: ", accuracy, "Test dataset F1 score: ", f1)
         print("---------------------------------")
 
+    def load_dataset(self, csv_path):
+        import pandas as pd
+
+        # parsing the csv is slow, so the parsed matrix is cached next to it in a .npz file
+        # named after the hash of the csv contents, a regenerated csv gets a new cache file
+        with open(csv_path, "rb") as fp:
+            dataset_hash = hashlib.sha256(fp.read()).hexdigest()[:16]
+        cache_path = f"{os.path.splitext(csv_path)[0]}.{dataset_hash}.npz"
+
+        if os.path.exists(cache_path):
+            with np.load(cache_path, allow_pickle=False) as cache:
+                X = pd.DataFrame(cache["X"], columns=cache["columns"].tolist())
+                y = pd.Series(cache["y"], name="label")
+            return X, y
+
+        df = pd.read_csv(csv_path)
+        X = df.drop("label", axis=1)
+        y = df["label"]
+
+        # write to a temporary file first so an interrupted write never leaves a broken cache under this hash
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as fp:
+            np.savez(fp, X=X.to_numpy(dtype=np.float64), y=y.to_numpy(), columns=np.array(X.columns, dtype=str))
+        os.replace(tmp_path, cache_path)
+        return X, y
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the matching model on model/data.csv.")
+    parser.add_argument("--search", action="store_true", help="run a successive halving hyperparameter search")
+    parser.add_argument("--calibrate", action="store_true", help="calibrate probabilities and save the calibrated model")
+    parser.add_argument("--n-candidates", type=int, default=60, help="number of random configurations the search starts with")
+    parser.add_argument("--max-resources", type=int, default=300, help="maximum number of trees a configuration is trained with")
+    args = parser.parse_args()
+
     model = Model()
-    model.train()
+    model.train(search=args.search, calibrate=args.calibrate, n_candidates=args.n_candidates, max_resources=args.max_resources)
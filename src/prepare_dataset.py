@@ -2,8 +2,6 @@ import os
 import random
 
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 from pymongo import MongoClient
 
 from constants import ITEMS_URL
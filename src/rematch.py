@@ -0,0 +1,301 @@
+import argparse
+import bisect
+import hashlib
+import itertools
+import json
+import logging
+import os
+import sys
+from collections import deque
+from multiprocessing import Pool
+from time import sleep
+
+import numpy as np
+import pandas as pd
+
+from contracts import item_to_process, match_result
+from data_transformer import DataTransformer
+from exceptions import UnknownGeometryType
+from matcher import Matcher, MATCH_PROBABILITY_THRESHOLD
+from model import Model
+from startup_bundle import load_startup_bundle
+
+
+current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# state shared by the pool workers, filled once per process by _init_worker
+_worker_state = {}
+
+
+def _init_worker(model_path, lost_items, found_items, niceness):
+    # lower the worker priority so the live consumer keeps getting CPU time
+    if niceness:
+        os.nice(niceness)
+    # score exactly like the live service, from the startup bundle when it was built from this model
+    model = Model()
+    bundle = load_startup_bundle(model_path=model_path)
+    if bundle is not None:
+        model.load_bundle(bundle)
+    else:
+        model.load_model(model_path)
+    _worker_state["model"] = model
+    _worker_state["data_transformer"] = DataTransformer(bundle=bundle)
+    _worker_state["lost_items"] = [item_to_process.from_dict(item) for item in lost_items]
+    _worker_state["found_items"] = [item_to_process.from_dict(item) for item in found_items]
+
+
+def _score_chunk(chunk):
+    chunk_id, lost_ids, pairs = chunk
+    model = _worker_state["model"]
+    data_transformer = _worker_state["data_transformer"]
+    lost_items = _worker_state["lost_items"]
+    found_items = _worker_state["found_items"]
+
+    matches = {lost_id: [] for lost_id in lost_ids}
+    failed_lost_ids = set()
+
+    rows = []
+    prepared_pairs = []
+    for lost_idx, found_idx in pairs:
+        lost_item, found_item = lost_items[lost_idx], found_items[found_idx]
+        try:
+            rows.append(data_transformer.prepare_data(lost_item, found_item))
+        except Exception as e:
+            # one broken pair must not abort the job, its lost item is left out and retried on the next run
+            logging.warning(f"Could not prepare lost item {lost_item.id} and found item {found_item.id}: {e!r}")
+            failed_lost_ids.add(lost_item.id)
+            continue
+        prepared_pairs.append((lost_item.id, found_item.id))
+
+    if rows:
+        prepared_df = pd.DataFrame(rows)
+        prepared_df = prepared_df.reindex(columns=model.feature_names, fill_value=0)
+
+        probabilities = model.predict_batch(prepared_df.values)
+
+        for (lost_id, found_id), probability in zip(prepared_pairs, probabilities):
+            if probability > MATCH_PROBABILITY_THRESHOLD:
+                matches[lost_id].append((found_id, float(probability)))
+
+    scored_matches = [(lost_id, lost_matches) for lost_id, lost_matches in matches.items() if lost_id not in failed_lost_ids]
+    return chunk_id, len(pairs), scored_matches, failed_lost_ids
+
+
+# Results are written to /matches/batch, and the job only relies on it storing the posted matches. It never deletes
+# anything, so old model matches the new model no longer produces (or that fall outside the optional date/space
+# blocking window and are not rescored) stay in the API. The checkpoint is written after every request, so after a
+# crash at most the matches of the last request are posted twice.
+class Rematcher:
+    def __init__(self, matcher, model_path, checkpoint_path, workers=None, chunk_size=2000, batch_size=500,
+                 pause=0.5, niceness=10, max_date_distance=None, max_spatial_distance=None):
+        self.matcher = matcher
+        self.data_transformer = matcher.data_transformer
+        self.model_path = model_path
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.pause = pause
+        self.niceness = niceness
+        self.max_date_distance = max_date_distance
+        self.max_spatial_distance = max_spatial_distance
+
+    def run(self):
+        model_hash = self._get_model_hash()
+        done_lost_ids = self._load_checkpoint(model_hash)
+
+        lost_items = self.matcher.get_items_from_db("lost")
+        found_items = self.matcher.get_items_from_db("found")
+        logging.info(f"Loaded {len(lost_items)} lost and {len(found_items)} found items, {len(done_lost_ids)} lost items already done")
+
+        # chunks are generated lazily while the pool works, only the found item index is built up front
+        chunks = self._generate_chunks(lost_items, found_items, done_lost_ids)
+
+        initargs = (self.model_path, lost_items, found_items, self.niceness)
+        scored = 0
+        saved = 0
+        failed_lost_ids = set()
+        with Pool(processes=self.workers, initializer=_init_worker, initargs=initargs) as pool:
+            # at most one chunk per worker is in flight and the next one is only submitted after the pause,
+            # so the workers go idle while the job is paused
+            pending = deque()
+            for chunk in itertools.islice(chunks, self.workers):
+                pending.append(pool.apply_async(_score_chunk, (chunk,)))
+
+            while pending:
+                chunk_id, pair_count, matches, chunk_failed_lost_ids = pending.popleft().get()
+
+                self._save_results(matches, model_hash, done_lost_ids)
+                scored += pair_count
+                saved += sum(len(lost_matches) for _, lost_matches in matches)
+                failed_lost_ids.update(chunk_failed_lost_ids)
+                logging.info(f"Chunk {chunk_id + 1} done, {scored} pairs scored, {saved} matches saved")
+
+                if self.pause:
+                    sleep(self.pause)
+
+                next_chunk = next(chunks, None)
+                if next_chunk is not None:
+                    pending.append(pool.apply_async(_score_chunk, (next_chunk,)))
+
+        logging.info(f"Re-match finished, {scored} pairs scored, {saved} matches saved")
+        if failed_lost_ids:
+            # the checkpoint is kept so the next run only retries the lost items that had failing pairs
+            logging.warning(f"{len(failed_lost_ids)} lost items had pairs that could not be scored and were not saved, run again to retry them")
+        elif os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def _generate_chunks(self, lost_items, found_items, done_lost_ids):
+        found_dates, found_order, found_bounds = self._index_found_items(found_items)
+
+        chunk_id = 0
+        chunk_lost_ids = []
+        chunk_pairs = []
+        for lost_idx, lost_dict in enumerate(lost_items):
+            if lost_dict["id"] in done_lost_ids:
+                continue
+            lost_item = item_to_process.from_dict(lost_dict)
+            lost_pairs = []
+            lost_bounds = self._get_bounds(lost_item)
+            if lost_bounds is not None:
+                # like the live matcher every found item with a location is a candidate, unless blocking is enabled
+                candidates = found_order
+
+                if self.max_date_distance is not None:
+                    # date blocking: only founds within the date window of the lost item
+                    max_date_distance = np.timedelta64(self.max_date_distance, "D")
+                    lost_date = np.datetime64(lost_item.date)
+                    start = bisect.bisect_left(found_dates, lost_date - max_date_distance)
+                    end = bisect.bisect_right(found_dates, lost_date + max_date_distance)
+                    candidates = candidates[start:end]
+
+                if self.max_spatial_distance is not None:
+                    # space blocking: only founds whose bounding boxes lie within reach of the lost item
+                    bounds = found_bounds[candidates]
+                    mask = (
+                        (bounds[:, 0] <= lost_bounds[2] + self.max_spatial_distance)
+                        & (bounds[:, 2] >= lost_bounds[0] - self.max_spatial_distance)
+                        & (bounds[:, 1] <= lost_bounds[3] + self.max_spatial_distance)
+                        & (bounds[:, 3] >= lost_bounds[1] - self.max_spatial_distance)
+                    )
+                    candidates = candidates[mask]
+
+                lost_pairs = [(lost_idx, int(found_idx)) for found_idx in candidates]
+
+            if chunk_pairs and len(chunk_pairs) + len(lost_pairs) > self.chunk_size:
+                yield chunk_id, chunk_lost_ids, chunk_pairs
+                chunk_id += 1
+                chunk_lost_ids = []
+                chunk_pairs = []
+            chunk_lost_ids.append(lost_dict["id"])
+            chunk_pairs.extend(lost_pairs)
+
+        if chunk_lost_ids:
+            yield chunk_id, chunk_lost_ids, chunk_pairs
+
+    def _index_found_items(self, found_items):
+        found_dates = []
+        found_bounds = []
+        valid_indices = []
+        for found_idx, found_dict in enumerate(found_items):
+            found_item = item_to_process.from_dict(found_dict)
+            bounds = self._get_bounds(found_item)
+            if bounds is None:
+                continue
+            valid_indices.append(found_idx)
+            found_dates.append(np.datetime64(found_item.date))
+            found_bounds.append(bounds)
+
+        # bounds are indexed by the position in found_items, items without geometry are never candidates
+        all_bounds = np.full((len(found_items), 4), np.nan)
+        if valid_indices:
+            all_bounds[valid_indices] = found_bounds
+
+        order = np.argsort(np.array(found_dates, dtype="datetime64[us]"), kind="stable")
+        sorted_dates = [found_dates[i] for i in order]
+        sorted_indices = np.array(valid_indices, dtype=int)[order]
+        return sorted_dates, sorted_indices, all_bounds
+
+    def _get_bounds(self, item):
+        try:
+            return self.data_transformer.get_projected_bounds(item.location)
+        except UnknownGeometryType:
+            logging.info(f"Item {item.id} has no usable location, skipping")
+            return None
+
+    def _save_results(self, matches, model_hash, done_lost_ids):
+        # whole lost items are packed into requests of up to batch_size matches and checkpointed right after
+        batch = []
+        batch_lost_ids = []
+        for lost_id, lost_matches in matches:
+            if batch and len(batch) + len(lost_matches) > self.batch_size:
+                self._save_batch(batch, batch_lost_ids, model_hash, done_lost_ids)
+                batch = []
+                batch_lost_ids = []
+            batch.extend(match_result(lost_id=lost_id, found_id=found_id, match_probability=probability) for found_id, probability in lost_matches)
+            batch_lost_ids.append(lost_id)
+
+        if batch_lost_ids:
+            self._save_batch(batch, batch_lost_ids, model_hash, done_lost_ids)
+
+    def _save_batch(self, batch, lost_ids, model_hash, done_lost_ids):
+        # a single lost item with more than batch_size matches still needs several requests
+        for start in range(0, len(batch), self.batch_size):
+            self.matcher.save_matches_to_db(batch[start:start + self.batch_size])
+        done_lost_ids.update(lost_ids)
+        self._save_checkpoint(model_hash, done_lost_ids)
+
+    def _get_model_hash(self):
+        with open(self.model_path, "rb") as fp:
+            return hashlib.sha256(fp.read()).hexdigest()
+
+    def _load_checkpoint(self, model_hash):
+        if not os.path.exists(self.checkpoint_path):
+            return set()
+        with open(self.checkpoint_path) as fp:
+            checkpoint = json.load(fp)
+        if checkpoint.get("model_hash") != model_hash:
+            logging.info("Checkpoint was made with a different model, starting over")
+            return set()
+        return set(checkpoint["done_lost_ids"])
+
+    def _save_checkpoint(self, model_hash, done_lost_ids):
+        # write to a temporary file first so a crash never leaves a half written checkpoint
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump({"model_hash": model_hash, "done_lost_ids": sorted(done_lost_ids)}, fp)
+        os.replace(tmp_path, self.checkpoint_path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Re-score all lost and found items with the current model.")
+    parser.add_argument("--model", default=current_dir + "/model/model.pkl", help="path to the model to score with")
+    parser.add_argument("--checkpoint", default=current_dir + "/model/rematch_checkpoint.json", help="path to the progress checkpoint")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: half of the CPUs)")
+    parser.add_argument("--chunk-size", type=int, default=2000, help="candidate pairs scored per chunk")
+    parser.add_argument("--batch-size", type=int, default=500, help="matches sent per /matches/batch request")
+    parser.add_argument("--pause", type=float, default=0.5, help="seconds the workers stay idle after each chunk")
+    parser.add_argument("--niceness", type=int, default=10, help="niceness increment for worker processes")
+    parser.add_argument("--max-date-distance", type=int, default=None, help="only score pairs at most this many days apart (default: no date blocking)")
+    parser.add_argument("--max-spatial-distance", type=float, default=None, help="only score pairs at most this many meters apart (default: no space blocking)")
+    args = parser.parse_args()
+
+    # the main process only talks to the API and computes locations for blocking, the workers do the scoring
+    data_transformer = DataTransformer(bundle=load_startup_bundle(model_path=args.model))
+    matcher = Matcher(model=None, data_transformer=data_transformer)
+
+    rematcher = Rematcher(
+        matcher=matcher,
+        model_path=args.model,
+        checkpoint_path=args.checkpoint,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        batch_size=args.batch_size,
+        pause=args.pause,
+        niceness=args.niceness,
+        max_date_distance=args.max_date_distance,
+        max_spatial_distance=args.max_spatial_distance,
+    )
+    rematcher.run()
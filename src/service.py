@@ -11,6 +11,7 @@ from contracts import item_to_process
 from data_transformer import DataTransformer
 from matcher import Matcher
 from model import Model
+from startup_bundle import MODEL_PATH, load_startup_bundle
 
 class MatcherService:
     def __init__(self, connection_parameters, matcher):
@@ -61,8 +62,13 @@ if __name__ == "__main__":
         credentials = PlainCredentials(username, password)
         connection_parameters = ConnectionParameters(host, port, '/', credentials)
     model = Model()
-    model.load_model(os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + "/model/model.pkl")
-    data_transformer = DataTransformer()
+    bundle = load_startup_bundle()
+    if bundle is not None:
+        model.load_bundle(bundle)
+    else:
+        logging.warning("No up to date startup bundle, loading the pickled model")
+        model.load_model(MODEL_PATH)
+    data_transformer = DataTransformer(bundle=bundle)
     matcher = Matcher(model=model, data_transformer=data_transformer)
     config = {}
     
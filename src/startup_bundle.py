@@ -0,0 +1,229 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import pickle
+import sys
+
+import numpy as np
+
+
+current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODEL_PATH = current_dir + "/model/model.pkl"
+TYPE_SIMILARITY_MATRIX_PATH = current_dir + "/model/type_similarity_matrix_gpt4.json"
+STARTUP_BUNDLE_PATH = current_dir + "/model/startup_bundle.npz"
+
+BUNDLE_KEYS = {
+    "node_feature", "node_threshold", "node_left", "node_right", "node_value", "tree_root", "tree_group",
+    "calibrated", "calibration_offsets", "calibration_x", "calibration_y", "feature_names",
+    "type_names", "type_similarity", "model_hash", "type_similarity_matrix_hash",
+}
+
+
+class ForestArrays:
+    """Random forest (optionally with isotonic calibration) flattened into numpy arrays.
+
+    Predicts the same probabilities as the pickled sklearn model without importing sklearn.
+    Trees are grouped: a plain forest is a single group, a calibrated model has one group
+    per calibration fold, each with its own isotonic curve.
+    """
+
+    def __init__(self, arrays):
+        self.node_feature = arrays["node_feature"]
+        self.node_threshold = arrays["node_threshold"]
+        self.node_left = arrays["node_left"]
+        self.node_right = arrays["node_right"]
+        self.node_value = arrays["node_value"]
+        self.tree_root = arrays["tree_root"]
+        self.tree_group = arrays["tree_group"]
+        self.calibrated = bool(arrays["calibrated"])
+        self.calibration_offsets = arrays["calibration_offsets"]
+        self.calibration_x = arrays["calibration_x"]
+        self.calibration_y = arrays["calibration_y"]
+        self.group_count = len(self.calibration_offsets) - 1
+        self.group_sizes = np.bincount(self.tree_group, minlength=self.group_count)
+        self.feature_names = arrays["feature_names"].tolist()
+
+    def predict_proba(self, X):
+        # sklearn compares float32 features against float64 thresholds, so do the same
+        X = np.asarray(X, dtype=np.float32)
+        samples = np.arange(X.shape[0])[None, :]
+
+        # walk all trees for all samples at once, one tree level per iteration
+        nodes = np.repeat(self.tree_root[:, None], X.shape[0], axis=1)
+        while True:
+            left = self.node_left[nodes]
+            active = left != -1
+            if not active.any():
+                break
+            go_left = X[samples, self.node_feature[nodes]] <= self.node_threshold[nodes]
+            nodes = np.where(active, np.where(go_left, left, self.node_right[nodes]), nodes)
+
+        group_proba = np.zeros((self.group_count, X.shape[0]))
+        np.add.at(group_proba, self.tree_group, self.node_value[nodes])
+        group_proba /= self.group_sizes[:, None]
+
+        if self.calibrated:
+            for group in range(self.group_count):
+                start, end = self.calibration_offsets[group], self.calibration_offsets[group + 1]
+                group_proba[group] = np.interp(group_proba[group], self.calibration_x[start:end], self.calibration_y[start:end])
+
+        positive = group_proba.mean(axis=0)
+        return np.column_stack([1 - positive, positive])
+
+
+def _flatten_forests(model):
+    from sklearn.calibration import CalibratedClassifierCV
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.isotonic import IsotonicRegression
+
+    if isinstance(model, RandomForestClassifier):
+        groups = [(model, None)]
+    elif isinstance(model, CalibratedClassifierCV):
+        groups = []
+        for calibrated_classifier in model.calibrated_classifiers_:
+            # the fitted forest is called base_estimator before sklearn 1.2
+            estimator = getattr(calibrated_classifier, "estimator", None)
+            if estimator is None:
+                estimator = calibrated_classifier.base_estimator
+            calibrator = calibrated_classifier.calibrators[0]
+            if not isinstance(estimator, RandomForestClassifier) or not isinstance(calibrator, IsotonicRegression):
+                raise ValueError("Only isotonic calibration of a random forest can be bundled")
+            groups.append((estimator, calibrator))
+    else:
+        raise ValueError(f"Cannot bundle model of type {type(model).__name__}")
+
+    node_feature, node_threshold, node_left, node_right, node_value = [], [], [], [], []
+    tree_root, tree_group = [], []
+    calibration_offsets, calibration_x, calibration_y = [0], [], []
+    node_count = 0
+    for group, (forest, calibrator) in enumerate(groups):
+        positive_class = list(forest.classes_).index(1)
+        for tree_estimator in forest.estimators_:
+            tree = tree_estimator.tree_
+            is_leaf = tree.children_left == -1
+
+            value = tree.value[:, 0, :]
+            normalizer = value.sum(axis=1)
+            normalizer[normalizer == 0] = 1
+
+            node_feature.append(np.where(is_leaf, 0, tree.feature))
+            node_threshold.append(tree.threshold)
+            node_left.append(np.where(is_leaf, -1, tree.children_left + node_count))
+            node_right.append(np.where(is_leaf, -1, tree.children_right + node_count))
+            node_value.append(value[:, positive_class] / normalizer)
+            tree_root.append(node_count)
+            tree_group.append(group)
+            node_count += tree.node_count
+
+        if calibrator is not None:
+            calibration_x.append(calibrator.X_thresholds_)
+            calibration_y.append(calibrator.y_thresholds_)
+            calibration_offsets.append(calibration_offsets[-1] + len(calibrator.X_thresholds_))
+        else:
+            calibration_offsets.append(calibration_offsets[-1])
+
+    return {
+        "node_feature": np.concatenate(node_feature).astype(np.int64),
+        "node_threshold": np.concatenate(node_threshold).astype(np.float64),
+        "node_left": np.concatenate(node_left).astype(np.int64),
+        "node_right": np.concatenate(node_right).astype(np.int64),
+        "node_value": np.concatenate(node_value).astype(np.float64),
+        "tree_root": np.array(tree_root, dtype=np.int64),
+        "tree_group": np.array(tree_group, dtype=np.int64),
+        "calibrated": np.array(groups[0][1] is not None),
+        "calibration_offsets": np.array(calibration_offsets, dtype=np.int64),
+        "calibration_x": np.concatenate(calibration_x) if calibration_x else np.zeros(0),
+        "calibration_y": np.concatenate(calibration_y) if calibration_y else np.zeros(0),
+    }
+
+
+def _type_similarity_arrays(type_similarity_matrix):
+    # same lookup as DataTransformer._compute_type_similarity, precomputed for every pair of types
+    type_names = list(type_similarity_matrix)
+    type_similarity = np.zeros((len(type_names), len(type_names)))
+    for i, lost_type in enumerate(type_names):
+        for j, found_type in enumerate(type_names):
+            similarity = type_similarity_matrix[lost_type].get(found_type, 0)
+            if not similarity:
+                similarity = type_similarity_matrix[found_type].get(lost_type, 0)
+            type_similarity[i, j] = similarity
+    return np.array(type_names, dtype=str), type_similarity
+
+
+def _sample_features(arrays, feature_count, sample_count=2000):
+    # values drawn around the split thresholds of each feature exercise both sides of every split
+    rng = np.random.default_rng(0)
+    is_split = arrays["node_left"] != -1
+    X = np.zeros((sample_count, feature_count))
+    for feature in range(feature_count):
+        thresholds = arrays["node_threshold"][is_split & (arrays["node_feature"] == feature)]
+        if len(thresholds) == 0:
+            continue
+        values = rng.choice(thresholds, sample_count)
+        X[:, feature] = values + rng.choice([-1, 0, 1], sample_count) * np.maximum(np.abs(values), 1) * 1e-3
+    return X
+
+
+def _verify_forest_arrays(model, arrays, feature_count):
+    X = _sample_features(arrays, feature_count)
+    expected = model.predict_proba(X)
+    actual = ForestArrays(arrays).predict_proba(X)
+    difference = np.abs(expected - actual).max()
+    if difference > 1e-9:
+        raise ValueError(f"Flattened forest differs from the pickled model by {difference}, refusing to write the bundle")
+
+
+def _file_hash(path):
+    with open(path, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+def build_startup_bundle(model_path=MODEL_PATH, type_similarity_matrix_path=TYPE_SIMILARITY_MATRIX_PATH, bundle_path=STARTUP_BUNDLE_PATH):
+    model = pickle.load(open(model_path, "rb"))
+    type_similarity_matrix = json.load(open(type_similarity_matrix_path))
+
+    arrays = _flatten_forests(model)
+    arrays["feature_names"] = np.array([str(name) for name in model.feature_names], dtype=str)
+    _verify_forest_arrays(model, arrays, len(arrays["feature_names"]))
+
+    arrays["type_names"], arrays["type_similarity"] = _type_similarity_arrays(type_similarity_matrix)
+    arrays["model_hash"] = np.array(_file_hash(model_path))
+    arrays["type_similarity_matrix_hash"] = np.array(_file_hash(type_similarity_matrix_path))
+
+    np.savez(bundle_path, **arrays)
+    logging.info(f"Startup bundle written to {bundle_path}")
+
+
+def load_startup_bundle(bundle_path=STARTUP_BUNDLE_PATH, model_path=MODEL_PATH, type_similarity_matrix_path=TYPE_SIMILARITY_MATRIX_PATH):
+    if not os.path.exists(bundle_path):
+        return None
+
+    # the whole file is read at once and parsed from memory
+    try:
+        with open(bundle_path, "rb") as fp:
+            data = fp.read()
+        with np.load(io.BytesIO(data), allow_pickle=False) as bundle:
+            arrays = {name: bundle[name] for name in bundle.files}
+    except Exception as e:
+        logging.warning(f"Could not read startup bundle {bundle_path}, ignoring it: {e!r}")
+        return None
+
+    missing_keys = BUNDLE_KEYS - arrays.keys()
+    if missing_keys:
+        logging.warning(f"Startup bundle {bundle_path} is missing {sorted(missing_keys)}, ignoring it")
+        return None
+
+    # the bundle is only used if it was built from the exact model and similarity matrix on disk
+    for path, key in ((model_path, "model_hash"), (type_similarity_matrix_path, "type_similarity_matrix_hash")):
+        if os.path.exists(path) and str(arrays[key]) != _file_hash(path):
+            logging.warning(f"Startup bundle was not built from {path}, ignoring it")
+            return None
+    return arrays
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    build_startup_bundle()